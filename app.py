@@ -7,10 +7,14 @@ import random
 import logging
 import unicodedata
 import string
+import math
+import hashlib
+import threading
 from collections import deque
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, g
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from langchain_community.vectorstores import Chroma
 from langchain_cohere import CohereEmbeddings
@@ -49,9 +53,31 @@ splitter = RecursiveCharacterTextSplitter(
 
 ALLOWED_EXTENSIONS = {"pdf", "txt", "docx"}
 
+# Admission control (per worker process: with N gunicorn workers a client gets up to N x these limits)
+RATE_LIMIT_PER_MIN = float(os.getenv("RATE_LIMIT_PER_MIN", "30"))   # token refill per client (<= 0 disables)
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "10"))       # bucket size per client
+ROUTE_COST = {"chat": 1, "upload": 5, "export": 2}                   # tokens per request
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", "8"))                 # total busy slots
+CHAT_RESERVED_SLOTS = 2   # slots upload/export can never take
+ROUTE_MAX_IN_FLIGHT = {"chat": MAX_IN_FLIGHT, "upload": 1, "export": 2}
+ROUTE_QUEUE_LIMIT = {"chat": 4, "upload": 0, "export": 1}             # waiters allowed per route
+ROUTE_QUEUE_WAIT = {"chat": 5.0, "upload": 0.0, "export": 1.0}       # max seconds to wait for a slot
+OVERLOAD_RETRY_AFTER = 5  # seconds
+# Thread rule: WEB_THREADS >= MAX_IN_FLIGHT + sum(ROUTE_QUEUE_LIMIT) + CHEAP_THREAD_HEADROOM,
+# so guardrail/intent replies and fast 429/503s always find a free thread.
+# WEB_THREADS is also what the Procfile passes to gunicorn --threads; queues/slots are shrunk at startup to fit.
+WEB_THREADS = int(os.getenv("WEB_THREADS", "16"))
+CHEAP_THREAD_HEADROOM = 3
+# Client identity: only the last TRUSTED_PROXY_HOPS X-Forwarded-For entries are trusted (1 on Heroku/Railway),
+# and X-API-Key only counts when it is one of the issued API_KEYS (comma-separated).
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1"))
+API_KEYS = {k.strip() for k in os.getenv("API_KEYS", "").split(",") if k.strip()}
+
 # ---------- App / Clients ----------
 app = Flask(__name__)
 CORS(app)
+if TRUSTED_PROXY_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
 
 embeddings = CohereEmbeddings(model="embed-english-v3.0", cohere_api_key=COHERE_API_KEY)
 vectorstore = Chroma(
@@ -208,9 +234,142 @@ def is_pricing_intent(raw_q: str, norm_q: str) -> bool:
         return True
     return bool(CURRENCY_RE.search(raw_q))
 
+# ---------- Admission control (rate limits, bounded in-flight, load shedding) ----------
+_buckets = {}             # client key -> [tokens, last_refill]
+_buckets_lock = threading.Lock()
+_slots = threading.Condition()
+_in_flight = {"chat": 0, "upload": 0, "export": 0}
+_waiting = {"chat": 0, "upload": 0, "export": 0}
+MAX_TRACKED_CLIENTS = 10000
+
+def _check_admission_settings():
+    """Clamp settings that would make a route fail on every request, warning about each change."""
+    global RATE_LIMIT_BURST, MAX_IN_FLIGHT
+    max_cost = max(ROUTE_COST.values())
+    if RATE_LIMIT_PER_MIN > 0 and RATE_LIMIT_BURST < max_cost:
+        logging.warning(f"RATE_LIMIT_BURST={RATE_LIMIT_BURST} is below the largest route cost; raised to {max_cost}")
+        RATE_LIMIT_BURST = float(max_cost)
+    if MAX_IN_FLIGHT <= CHAT_RESERVED_SLOTS:
+        logging.warning(f"MAX_IN_FLIGHT={MAX_IN_FLIGHT} leaves no slots for /upload and /export; "
+                        f"raised to {CHAT_RESERVED_SLOTS + 1}")
+        MAX_IN_FLIGHT = CHAT_RESERVED_SLOTS + 1
+    # Fit slots + waiters into WEB_THREADS: slots first, then waiters take what is left
+    budget = WEB_THREADS - CHEAP_THREAD_HEADROOM
+    if MAX_IN_FLIGHT > budget:
+        fitted = max(CHAT_RESERVED_SLOTS + 1, budget)
+        logging.warning(f"MAX_IN_FLIGHT={MAX_IN_FLIGHT} does not fit WEB_THREADS={WEB_THREADS}; lowered to {fitted}")
+        MAX_IN_FLIGHT = fitted
+        if MAX_IN_FLIGHT > budget:
+            logging.warning(f"WEB_THREADS={WEB_THREADS} is too small to keep {CHEAP_THREAD_HEADROOM} threads for cheap replies")
+    for route in ("upload", "export", "chat"):
+        excess = MAX_IN_FLIGHT + sum(ROUTE_QUEUE_LIMIT.values()) - budget
+        if excess > 0 and ROUTE_QUEUE_LIMIT[route]:
+            cut = min(excess, ROUTE_QUEUE_LIMIT[route])
+            logging.warning(f"Queue for {route} reduced by {cut} to fit WEB_THREADS={WEB_THREADS}")
+            ROUTE_QUEUE_LIMIT[route] -= cut
+    ROUTE_MAX_IN_FLIGHT["chat"] = MAX_IN_FLIGHT
+
+_check_admission_settings()
+
+def client_key() -> str:
+    """Issued API key (hashed, so it never lands in logs) or the proxy-resolved client IP."""
+    api_key = (request.headers.get("X-API-Key") or "").strip()
+    if api_key in API_KEYS:
+        return "key:" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+    return f"ip:{request.remote_addr or 'unknown'}"
+
+def take_tokens(key: str, cost: float) -> float:
+    """Spend tokens from the client's bucket. Returns 0 if allowed, else seconds until enough refill."""
+    rate = RATE_LIMIT_PER_MIN / 60.0
+    if rate <= 0:
+        return 0.0
+    now = time.monotonic()
+    with _buckets_lock:
+        if key not in _buckets and len(_buckets) >= MAX_TRACKED_CLIENTS:
+            # Drop buckets that have refilled completely; they carry no state
+            for k in [k for k, (t, last) in _buckets.items() if t + (now - last) * rate >= RATE_LIMIT_BURST]:
+                del _buckets[k]
+        tokens, last = _buckets.get(key, (RATE_LIMIT_BURST, now))
+        tokens = min(RATE_LIMIT_BURST, tokens + (now - last) * rate)
+        if tokens >= cost:
+            _buckets[key] = [tokens - cost, now]
+            return 0.0
+        _buckets[key] = [tokens, now]
+        return (cost - tokens) / rate
+
+def refund_tokens(key: str, cost: float):
+    with _buckets_lock:
+        if key in _buckets:
+            _buckets[key][0] = min(RATE_LIMIT_BURST, _buckets[key][0] + cost)
+
+def _has_slot(route: str) -> bool:
+    total = sum(_in_flight.values())
+    if _in_flight[route] >= ROUTE_MAX_IN_FLIGHT[route]:
+        return False
+    if route == "chat":
+        return total < MAX_IN_FLIGHT
+    # /upload and /export leave the reserved slots to /chat
+    return total < MAX_IN_FLIGHT - CHAT_RESERVED_SLOTS
+
+def _acquire_slot(route: str) -> bool:
+    with _slots:
+        if _has_slot(route):
+            _in_flight[route] += 1
+            return True
+        if _waiting[route] >= ROUTE_QUEUE_LIMIT[route] or ROUTE_QUEUE_WAIT[route] <= 0:
+            return False
+        _waiting[route] += 1
+        try:
+            deadline = time.monotonic() + ROUTE_QUEUE_WAIT[route]
+            while not _has_slot(route):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                _slots.wait(remaining)
+            _in_flight[route] += 1
+            return True
+        finally:
+            _waiting[route] -= 1
+
+def _release_slot(route: str):
+    with _slots:
+        _in_flight[route] = max(0, _in_flight[route] - 1)
+        _slots.notify_all()
+
+def _reject(status: int, message: str, retry_after: float):
+    resp = jsonify({"error": message})
+    resp.status_code = status
+    resp.headers["Retry-After"] = str(max(1, int(math.ceil(retry_after))))
+    return resp
+
+def admit(route: str):
+    """Apply rate limit and in-flight cap for an expensive route.
+    Returns None when admitted (slot is released on teardown), else a 429/503 response."""
+    key = client_key()
+    wait = take_tokens(key, ROUTE_COST[route])
+    if wait > 0:
+        logging.info(f"Rate limited {route} for {key} (retry in {wait:.1f}s)")
+        return _reject(429, "Too many requests. Please slow down and try again shortly.", wait)
+    if not _acquire_slot(route):
+        # Overload is not the client's fault; give the tokens back
+        refund_tokens(key, ROUTE_COST[route])
+        logging.warning(f"Shedding {route}: in_flight={_in_flight} waiting={_waiting}")
+        return _reject(503, "The assistant is busy right now. Please try again shortly.", OVERLOAD_RETRY_AFTER)
+    g.admitted_route = route
+    return None
+
+@app.teardown_request
+def release_admission(exc=None):
+    route = g.pop("admitted_route", None)
+    if route:
+        _release_slot(route)
+
 # ---------- Routes ----------
 @app.route("/upload", methods=["POST"])
 def upload_file():
+    rejected = admit("upload")
+    if rejected:
+        return rejected
     try:
         files = request.files.getlist("files")
         if not files:
@@ -293,6 +452,11 @@ def chat():
     if any(k in norm_q for k in contact_keywords):
         return jsonify({"answer": CONTACT_SENTENCE, "fail_count": fail_count})
 
+    # 1.1) Admission control: only questions that reach Cohere are limited
+    rejected = admit("chat")
+    if rejected:
+        return rejected
+
     # 2) Retrieve candidates (MMR for diversity)
     try:
         raw_docs = vectorstore.max_marginal_relevance_search(
@@ -378,6 +542,9 @@ Answer:
 
 @app.route("/export", methods=["POST"])
 def export():
+    rejected = admit("export")
+    if rejected:
+        return rejected
     try:
         data = request.json or {}
         export_type = data.get("type", "txt")
@@ -0,0 +1,444 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import sqlite3
+import argparse
+import logging
+import tempfile
+from typing import List, Dict, Optional, Tuple
+
+import numpy as np
+import chromadb
+
+# ----- Config -----
+SNAPSHOT_FORMAT = "agent42-chroma-snapshot"
+SNAPSHOT_VERSION = 2      # v2: strings stored as UTF-8 bytes + offsets
+DEFAULT_COLLECTION = "langchain"
+DEFAULT_CHROMA_DIR = "chroma_db"
+DEFAULT_BATCH_SIZE = 1000
+STRING_COLUMNS = ("ids", "documents", "metadatas")
+COLUMNS = ("ids_data", "ids_offsets", "embeddings", "documents_data", "documents_offsets",
+           "has_document", "metadatas_data", "metadatas_offsets")
+SELF_LOOKUP_K = 5
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+
+# ----- Store access -----
+def clear_client_cache():
+    # PersistentClient instances on the same path share cached state and open file handles
+    try:
+        chromadb.api.client.SharedSystemClient.clear_system_cache()
+    except Exception:
+        pass
+
+
+def open_collection(chroma_dir: str, collection: str):
+    if not os.path.isdir(chroma_dir):
+        raise RuntimeError(f"Chroma directory not found: {chroma_dir}")
+    client = chromadb.PersistentClient(path=chroma_dir)
+    return client, client.get_collection(collection)
+
+
+def encode_strings(values: List[str]):
+    """Variable-length column: concatenated UTF-8 bytes plus n+1 offsets."""
+    encoded = [v.encode("utf-8") for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded], dtype=np.int64)
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def decode_strings(cols: Dict[str, np.ndarray], name: str, start: int = 0, end: Optional[int] = None) -> List[str]:
+    offsets = cols[f"{name}_offsets"]
+    end = len(offsets) - 1 if end is None else end
+    base = int(offsets[start])
+    buf = cols[f"{name}_data"][base:int(offsets[end])].tobytes()
+    return [buf[int(offsets[i]) - base:int(offsets[i + 1]) - base].decode("utf-8") for i in range(start, end)]
+
+
+def row_count(cols: Dict[str, np.ndarray]) -> int:
+    return len(cols["ids_offsets"]) - 1
+
+
+def read_collection(col, batch_size: int) -> Dict[str, np.ndarray]:
+    """Read every record of a collection into columnar arrays (no re-embedding)."""
+    ids: List[str] = []
+    embs: List[np.ndarray] = []
+    docs: List[str] = []
+    has_doc: List[bool] = []
+    metas: List[str] = []
+
+    total = col.count()
+    for offset in range(0, total, batch_size):
+        page = col.get(include=["embeddings", "documents", "metadatas"], limit=batch_size, offset=offset)
+        page_ids = list(page["ids"])
+        if not page_ids:
+            break
+        ids.extend(page_ids)
+        embs.append(np.asarray(page["embeddings"], dtype=np.float32))
+        for d in page.get("documents") or [None] * len(page_ids):
+            docs.append(d or "")
+            has_doc.append(d is not None)
+        for m in page.get("metadatas") or [None] * len(page_ids):
+            metas.append(json.dumps(m or {}, ensure_ascii=False, sort_keys=True))
+
+    cols = {
+        "embeddings": np.concatenate(embs) if embs else np.zeros((0, 0), dtype=np.float32),
+        "has_document": np.array(has_doc, dtype=bool),
+    }
+    for name, values in (("ids", ids), ("documents", docs), ("metadatas", metas)):
+        cols[f"{name}_data"], cols[f"{name}_offsets"] = encode_strings(values)
+    return cols
+
+
+def columns_checksum(cols: Dict[str, np.ndarray]) -> str:
+    h = hashlib.sha256()
+    for name in COLUMNS:
+        arr = np.ascontiguousarray(cols[name])
+        h.update(name.encode("utf-8"))
+        h.update(str(arr.dtype).encode("utf-8"))
+        h.update(str(arr.shape).encode("utf-8"))
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+def sqlite_path(chroma_dir: str) -> str:
+    return os.path.join(chroma_dir, "chroma.sqlite3")
+
+
+def dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for fn in files:
+            total += os.path.getsize(os.path.join(root, fn))
+    return total
+
+
+# ----- Snapshot I/O -----
+def write_snapshot(out_path: str, cols: Dict[str, np.ndarray], collection: str, collection_meta: Optional[Dict]):
+    manifest = {
+        "format": SNAPSHOT_FORMAT,
+        "version": SNAPSHOT_VERSION,
+        "collection": collection,
+        "collection_metadata": collection_meta or {},
+        "count": row_count(cols),
+        "dim": int(cols["embeddings"].shape[1]) if cols["embeddings"].ndim == 2 else 0,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "sha256": columns_checksum(cols),
+    }
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, manifest=np.array(json.dumps(manifest)), **cols)
+    os.replace(tmp_path, out_path)
+    return manifest
+
+
+def load_snapshot(path: str):
+    if not os.path.isfile(path):
+        raise RuntimeError(f"Snapshot not found: {path}")
+    with np.load(path, allow_pickle=False) as data:
+        manifest = json.loads(str(data["manifest"]))
+        if manifest.get("format") != SNAPSHOT_FORMAT:
+            raise RuntimeError(f"Not a chroma snapshot: {path}")
+        if manifest.get("version", 0) != SNAPSHOT_VERSION:
+            raise RuntimeError(f"Snapshot version {manifest.get('version')} is not supported "
+                               f"(expected {SNAPSHOT_VERSION}); re-export it with this tool")
+        cols = {name: data[name] for name in COLUMNS}
+    return manifest, cols
+
+
+def check_columns(manifest: Dict, cols: Dict[str, np.ndarray]) -> List[str]:
+    """Returns a list of problems (empty when the snapshot is consistent)."""
+    problems = []
+    n = manifest.get("count", -1)
+    for name in ("embeddings", "has_document"):
+        if len(cols[name]) != n:
+            problems.append(f"column '{name}' has {len(cols[name])} rows, manifest says {n}")
+    for name in STRING_COLUMNS:
+        offsets, data = cols[f"{name}_offsets"], cols[f"{name}_data"]
+        if len(offsets) - 1 != n:
+            problems.append(f"column '{name}' has {len(offsets) - 1} rows, manifest says {n}")
+        elif offsets[0] != 0 or offsets[-1] != len(data) or (np.diff(offsets) < 0).any():
+            problems.append(f"column '{name}' has invalid offsets")
+    if problems:
+        return problems
+    emb = cols["embeddings"]
+    if n and (emb.ndim != 2 or emb.shape[1] != manifest.get("dim")):
+        problems.append(f"embeddings shape {emb.shape} does not match dim={manifest.get('dim')}")
+    elif n and not np.isfinite(emb).all():
+        problems.append("embeddings contain NaN/Inf values")
+    if columns_checksum(cols) != manifest.get("sha256"):
+        problems.append("checksum mismatch")
+        return problems
+    try:
+        ids = decode_strings(cols, "ids")
+    except UnicodeDecodeError:
+        return problems + ["ids are not valid UTF-8"]
+    if len(set(ids)) != len(ids):
+        problems.append("duplicate ids")
+    return problems
+
+
+# ----- Restore -----
+def restore_columns(chroma_dir: str, collection: str, cols: Dict[str, np.ndarray],
+                    collection_meta: Optional[Dict], batch_size: int) -> int:
+    client = chromadb.PersistentClient(path=chroma_dir)
+    col = client.create_collection(collection, metadata=collection_meta or None)
+    n = row_count(cols)
+    for start in range(0, n, batch_size):
+        end = min(start + batch_size, n)
+        docs = [d if keep else None for d, keep in
+                zip(decode_strings(cols, "documents", start, end), cols["has_document"][start:end].tolist())]
+        metas = [json.loads(m) or None for m in decode_strings(cols, "metadatas", start, end)]
+        col.add(
+            ids=decode_strings(cols, "ids", start, end),
+            embeddings=cols["embeddings"][start:end].tolist(),
+            documents=docs,
+            metadatas=metas,
+        )
+    return col.count()
+
+
+def build_and_swap(chroma_dir: str, collection: str, cols: Dict[str, np.ndarray],
+                   collection_meta: Optional[Dict], batch_size: int, prefix: str) -> Tuple[int, Optional[str]]:
+    """
+    Build a fresh store in a sibling temp directory, verify it, then swap it in for chroma_dir.
+    The existing store is untouched until the swap and is kept as <dir>.bak-<timestamp>.
+    Returns (count, backup_path or None).
+    """
+    chroma_dir = os.path.abspath(chroma_dir).rstrip(os.sep)
+    new_dir = tempfile.mkdtemp(prefix=prefix, dir=os.path.dirname(chroma_dir))
+    try:
+        count = restore_columns(new_dir, collection, cols, collection_meta, batch_size)
+        if count != row_count(cols):
+            raise RuntimeError(f"Rebuilt store has {count} records, expected {row_count(cols)}")
+        vacuum_sqlite(new_dir)
+        problems = verify_store(new_dir, collection, batch_size)
+        if problems:
+            raise RuntimeError(f"Rebuilt store failed verification: {'; '.join(problems)}")
+        clear_client_cache()
+        # mkdtemp creates 0700; the app may run as another user/group
+        if os.path.isdir(chroma_dir):
+            shutil.copymode(chroma_dir, new_dir)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(new_dir, 0o777 & ~umask)
+    except Exception:
+        clear_client_cache()
+        shutil.rmtree(new_dir, ignore_errors=True)
+        raise
+
+    backup = None
+    if os.path.exists(chroma_dir):
+        backup = f"{chroma_dir}.bak-{time.strftime('%Y%m%d%H%M%S')}"
+        os.rename(chroma_dir, backup)
+    os.rename(new_dir, chroma_dir)
+    return count, backup
+
+
+def vacuum_sqlite(chroma_dir: str):
+    path = sqlite_path(chroma_dir)
+    if not os.path.isfile(path):
+        return
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+
+# ----- Verification -----
+def verify_store(chroma_dir: str, collection: str, batch_size: int) -> List[str]:
+    problems = []
+    path = sqlite_path(chroma_dir)
+    if os.path.isfile(path):
+        conn = sqlite3.connect(path)
+        try:
+            result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+        finally:
+            conn.close()
+        if result != "ok":
+            problems.append(f"sqlite integrity_check: {result}")
+
+    _, col = open_collection(chroma_dir, collection)
+    cols = read_collection(col, batch_size)
+    ids = decode_strings(cols, "ids")
+    n = len(ids)
+    if n != col.count():
+        problems.append(f"read {n} records, collection reports {col.count()}")
+    if len(set(ids)) != n:
+        problems.append("duplicate ids")
+    if n and not np.isfinite(cols["embeddings"]).all():
+        problems.append("embeddings contain NaN/Inf values")
+    if n:
+        # Each sampled record should be reachable through the HNSW index. Identical chunks share
+        # an embedding and HNSW is approximate, so a hit is "own id in top k" or "distance ~ 0".
+        step = max(1, n // 20)
+        sample = cols["embeddings"][::step]
+        expected = ids[::step]
+        res = col.query(query_embeddings=sample.tolist(), n_results=min(SELF_LOOKUP_K, n), include=["distances"])
+        misses = 0
+        for want, got, dist in zip(expected, res["ids"], res["distances"]):
+            if want not in got and not (len(dist) and abs(dist[0]) <= 1e-4):
+                misses += 1
+        if misses:
+            problems.append(f"index self-lookup missed {misses}/{len(expected)} sampled records")
+    return problems
+
+
+# ----- Benchmark -----
+def bench_open(chroma_dir: str, collection: str, runs: int) -> Dict[str, float]:
+    """Median seconds to open the store, count it and run one query (fresh client each run)."""
+    open_times, query_times = [], []
+    for _ in range(runs):
+        clear_client_cache()  # time a cold open, not a cached client
+        t0 = time.perf_counter()
+        _, col = open_collection(chroma_dir, collection)
+        n = col.count()
+        t1 = time.perf_counter()
+        if n:
+            probe = col.get(limit=1, include=["embeddings"])["embeddings"]
+            col.query(query_embeddings=np.asarray(probe, dtype=np.float32).tolist(), n_results=min(10, n), include=[])
+        t2 = time.perf_counter()
+        open_times.append(t1 - t0)
+        query_times.append(t2 - t1)
+    return {
+        "open_s": float(np.median(open_times)),
+        "first_query_s": float(np.median(query_times)),
+        "size_mb": dir_size(chroma_dir) / 1e6,
+    }
+
+
+def print_bench(label: str, b: Dict[str, float]):
+    print(f"{label:<8} open={b['open_s'] * 1000:.1f}ms  first_query={b['first_query_s'] * 1000:.1f}ms  size={b['size_mb']:.2f}MB")
+
+
+# ----- Commands -----
+def cmd_export(args):
+    _, col = open_collection(args.chroma_dir, args.collection)
+    t0 = time.perf_counter()
+    cols = read_collection(col, args.batch_size)
+    manifest = write_snapshot(args.out, cols, args.collection, col.metadata)
+    logging.info(f"[OK] exported {manifest['count']} records (dim={manifest['dim']}) "
+                 f"to {args.out} in {time.perf_counter() - t0:.1f}s ({os.path.getsize(args.out) / 1e6:.2f}MB)")
+
+
+def cmd_restore(args):
+    t0 = time.perf_counter()
+    manifest, cols = load_snapshot(args.snapshot)
+    problems = check_columns(manifest, cols)
+    if problems:
+        raise RuntimeError(f"Snapshot failed verification: {'; '.join(problems)}")
+    logging.info(f"Loaded snapshot ({manifest['count']} records) in {time.perf_counter() - t0:.2f}s")
+
+    if os.path.exists(args.chroma_dir) and os.listdir(args.chroma_dir):
+        if not args.force:
+            raise RuntimeError(f"{args.chroma_dir} is not empty. Pass --force to replace it.")
+        require_app_stopped(args)
+    count, backup = build_and_swap(args.chroma_dir, args.collection, cols, manifest.get("collection_metadata"),
+                                   args.batch_size, prefix=".restore_")
+    logging.info(f"[OK] restored {count} records into {args.chroma_dir} (collection: {args.collection}) "
+                 f"in {time.perf_counter() - t0:.1f}s")
+    if backup:
+        print(f"Previous store kept at: {backup}")
+
+
+def require_app_stopped(args):
+    # Writes from /upload after the read would be lost, and running workers keep the old directory open
+    if not args.app_stopped:
+        raise RuntimeError("Replacing the store is only safe while app.py is stopped. "
+                           "Stop the app (all gunicorn workers), then re-run with --app-stopped.")
+
+
+def cmd_compact(args):
+    require_app_stopped(args)
+    chroma_dir = os.path.abspath(args.chroma_dir).rstrip(os.sep)
+    before = bench_open(chroma_dir, args.collection, args.runs)
+
+    _, col = open_collection(chroma_dir, args.collection)
+    cols = read_collection(col, args.batch_size)
+    collection_meta = col.metadata
+    clear_client_cache()
+
+    count, backup = build_and_swap(chroma_dir, args.collection, cols, collection_meta,
+                                   args.batch_size, prefix=".compact_")
+    if args.delete_backup and backup:
+        shutil.rmtree(backup, ignore_errors=True)
+        backup = None
+
+    after = bench_open(chroma_dir, args.collection, args.runs)
+    print(f"\n=== COMPACTED {count} records ===")
+    print_bench("before", before)
+    print_bench("after", after)
+    if backup:
+        print(f"Backup: {backup}")
+
+
+def cmd_verify(args):
+    if args.snapshot:
+        manifest, cols = load_snapshot(args.snapshot)
+        problems = check_columns(manifest, cols)
+        target = args.snapshot
+    else:
+        problems = verify_store(args.chroma_dir, args.collection, args.batch_size)
+        target = args.chroma_dir
+    if problems:
+        for p in problems:
+            logging.error(f"[FAIL] {p}")
+        raise SystemExit(1)
+    logging.info(f"[OK] {target} passed integrity checks")
+
+
+def cmd_bench(args):
+    print_bench("store", bench_open(args.chroma_dir, args.collection, args.runs))
+    if args.snapshot:
+        times = []
+        for _ in range(args.runs):
+            t0 = time.perf_counter()
+            load_snapshot(args.snapshot)
+            times.append(time.perf_counter() - t0)
+        print(f"snapshot load={float(np.median(times)) * 1000:.1f}ms  size={os.path.getsize(args.snapshot) / 1e6:.2f}MB")
+
+
+# ----- Main -----
+def main():
+    p = argparse.ArgumentParser(description="Snapshot, restore, compact and verify the Chroma store.")
+    p.add_argument("--chroma-dir", default=DEFAULT_CHROMA_DIR)
+    p.add_argument("--collection", default=DEFAULT_COLLECTION)
+    p.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    sub = p.add_subparsers(dest="command", required=True)
+
+    s = sub.add_parser("export", help="Write the collection to a versioned .npz snapshot (ids, embeddings, documents, metadata)")
+    s.add_argument("--out", required=True, help="Snapshot path, e.g. chroma_snapshot.npz")
+    s.set_defaults(func=cmd_export)
+
+    s = sub.add_parser("restore", help="Rebuild --chroma-dir from a snapshot without re-embedding")
+    s.add_argument("snapshot")
+    s.add_argument("--force", action="store_true", help="Replace a non-empty --chroma-dir (kept as <dir>.bak-<timestamp>)")
+    s.add_argument("--app-stopped", action="store_true", help="Confirm app.py is stopped (required with --force)")
+    s.set_defaults(func=cmd_restore)
+
+    s = sub.add_parser("compact", help="Rebuild and vacuum the store (app must be stopped), then report open times before/after")
+    s.add_argument("--app-stopped", action="store_true", help="Confirm app.py is stopped; required")
+    s.add_argument("--delete-backup", action="store_true", help="Remove the pre-compaction <dir>.bak-<timestamp> afterwards")
+    s.add_argument("--runs", type=int, default=3)
+    s.set_defaults(func=cmd_compact)
+
+    s = sub.add_parser("verify", help="Check integrity of the live store, or of a snapshot with --snapshot")
+    s.add_argument("--snapshot", default=None)
+    s.set_defaults(func=cmd_verify)
+
+    s = sub.add_parser("bench", help="Time store open/first query (and snapshot load with --snapshot)")
+    s.add_argument("--snapshot", default=None)
+    s.add_argument("--runs", type=int, default=3)
+    s.set_defaults(func=cmd_bench)
+
+    args = p.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()